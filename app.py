@@ -30,6 +30,8 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Orari di inizio degli allenamenti, per assegnare le presenze alla sessione giusta
+app.config["TRAINING_SCHEDULE"] = os.environ.get("TRAINING_SCHEDULE", "17:00,18:30")
 
 # initialize the app with the extensions
 db.init_app(app)
@@ -47,7 +49,7 @@ def load_user(user_id):
 
 with app.app_context():
     # Import models here so they are registered with SQLAlchemy
-    from models import Athlete, Payment, Exam, User  # noqa: F401
+    from models import Athlete, Payment, Exam, User, TrainingSession, Attendance, MonthlyAttendance  # noqa: F401
     db.create_all()
 
 # Import routes after db initialization to avoid circular imports
@@ -0,0 +1,287 @@
+"""Training attendance.
+
+Check-ins are buffered in memory and written in bulk: one insert for the
+held sessions, one for the raw check-ins and one upsert for the monthly
+counters. Reports only read the counters and the held sessions, never the
+raw check-ins.
+
+A check-in is assigned to the nearest session start of the club schedule
+(app.config['TRAINING_SCHEDULE'], e.g. "17:00,18:30"), so early and late
+arrivals count for the same session.
+"""
+import atexit
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import db
+from models import Athlete, Payment, TrainingSession, Attendance, MonthlyAttendance, BELT_COLORS
+
+FLUSH_SIZE = 50  # Write as soon as this many check-ins are pending
+FLUSH_INTERVAL = 2  # Seconds between background writes
+MAX_PENDING = 5000  # Refuse new check-ins past this backlog
+MAX_BACKOFF = 60  # Seconds: longest wait between retries of a failing batch
+SPLIT_AFTER_FAILURES = 3  # Then write the batch row by row to isolate bad check-ins
+CHECKIN_WINDOW = 60  # Minutes: a check-in this close to a session already attended is the same visit
+
+logger = logging.getLogger(__name__)
+
+
+def parse_schedule(value):
+    """Session start times "HH:MM,HH:MM" as sorted minutes after midnight"""
+    starts = []
+    for start in value.split(','):
+        hours, minutes = start.strip().split(':')
+        starts.append(int(hours) * 60 + int(minutes))
+    return sorted(starts)
+
+
+def session_slot(when, schedule):
+    """Start (minutes after midnight) of the scheduled session nearest to a check-in"""
+    minute = when.hour * 60 + when.minute
+    return min(schedule, key=lambda start: abs(start - minute))
+
+
+def _insert(model):
+    """Dialect insert supporting ON CONFLICT (PostgreSQL and SQLite)"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+
+def write_checkins(checkins):
+    """Write (date, athlete_id, slot, minute) check-ins and update the counters.
+
+    Check-ins of deleted athletes, repeated check-ins and check-ins within
+    CHECKIN_WINDOW minutes of a session the athlete already attended that
+    day are ignored. Returns the number of new check-ins.
+    """
+    if not checkins:
+        return 0
+
+    with db.engine.begin() as conn:
+        athlete_ids = {athlete_id for _, athlete_id, _, _ in checkins}
+        days = {day for day, _, _, _ in checkins}
+        existing = set(conn.scalars(select(Athlete.id).where(Athlete.id.in_(athlete_ids))))
+
+        attended = defaultdict(list)
+        for day, athlete_id, slot in conn.execute(select(
+            Attendance.date, Attendance.athlete_id, Attendance.slot
+        ).where(Attendance.date.in_(days), Attendance.athlete_id.in_(existing))):
+            attended[(day, athlete_id)].append(slot)
+
+        rows = []
+        for day, athlete_id, slot, minute in sorted(checkins):
+            if athlete_id not in existing:
+                continue
+            slots = attended[(day, athlete_id)]
+            if slot in slots or any(abs(minute - start) < CHECKIN_WINDOW for start in slots):
+                continue
+            slots.append(slot)
+            rows.append({'date': day, 'athlete_id': athlete_id, 'slot': slot})
+        if not rows:
+            return 0
+
+        sessions = {(row['date'], row['slot']) for row in rows}
+        conn.execute(_insert(TrainingSession).values(
+            [{'date': day, 'slot': slot} for day, slot in sessions]
+        ).on_conflict_do_nothing())
+
+        inserted = conn.execute(_insert(Attendance).values(rows).on_conflict_do_nothing().returning(
+            Attendance.date, Attendance.athlete_id
+        )).all()
+
+        counters = Counter((day.year, day.month, athlete_id) for day, athlete_id in inserted)
+        if counters:
+            stmt = _insert(MonthlyAttendance).values([
+                {'year': year, 'month': month, 'athlete_id': athlete_id, 'checkins': count}
+                for (year, month, athlete_id), count in counters.items()
+            ])
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=['year', 'month', 'athlete_id'],
+                set_={'checkins': MonthlyAttendance.checkins + stmt.excluded.checkins}
+            ))
+
+    return len(inserted)
+
+
+class CheckinBuffer:
+    """Collects check-ins of this worker and writes them in batches"""
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._app = None
+        self._failures = 0
+        self._retry_at = 0
+
+    def add(self, app, athlete_id, when=None):
+        """Queue a check-in, returning False if the backlog is full"""
+        when = when or datetime.now()
+        slot = session_slot(when, parse_schedule(app.config['TRAINING_SCHEDULE']))
+        with self._lock:
+            if len(self._pending) >= MAX_PENDING:
+                return False
+            self._pending.append((when.date(), athlete_id, slot, when.hour * 60 + when.minute))
+            self._app = app
+            # Started lazily so it lives in the worker, not in the pre-fork master
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            full = len(self._pending) >= FLUSH_SIZE
+        if full:
+            self.flush()
+        return True
+
+    def flush(self, force=False):
+        """Write every pending check-in.
+
+        A failing batch is kept and retried with exponential backoff (unless
+        force is set). After SPLIT_AFTER_FAILURES attempts it is written row
+        by row: only rows rejected on their own by the database (integrity or
+        data errors) are dropped; an outage keeps every row queued.
+        """
+        with self._lock:
+            if not force and time.monotonic() < self._retry_at:
+                return 0
+            pending, self._pending = self._pending, []
+            split = self._failures >= SPLIT_AFTER_FAILURES
+        if not pending:
+            return 0
+
+        written = 0
+        try:
+            with self._app.app_context():
+                if split:
+                    for index, checkin in enumerate(pending):
+                        try:
+                            written += write_checkins([checkin])
+                        except (IntegrityError, DataError):
+                            logger.exception("Presenza scartata dal database: %s", checkin)
+                        except Exception:
+                            pending = pending[index:]
+                            raise
+                else:
+                    written = write_checkins(pending)
+        except Exception as error:
+            with self._lock:
+                self._failures += 1
+                if isinstance(error, (IntegrityError, DataError)):
+                    # A bad row rather than an outage: isolate it right away
+                    self._failures = max(self._failures, SPLIT_AFTER_FAILURES)
+                    delay = FLUSH_INTERVAL
+                else:
+                    delay = min(FLUSH_INTERVAL * 2 ** self._failures, MAX_BACKOFF)
+                self._retry_at = time.monotonic() + delay
+                # Never drop acknowledged check-ins: add() already refuses new
+                # ones past MAX_PENDING
+                self._pending[:0] = pending
+            logger.exception("Scrittura di %d presenze fallita, riprovo tra %d s", len(pending), delay)
+            return written
+
+        with self._lock:
+            self._failures = 0
+            self._retry_at = 0
+        return written
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+checkin_buffer = CheckinBuffer()
+atexit.register(checkin_buffer.flush, force=True)
+
+
+def _months_due(year, month=None, enrollment_date=None):
+    """Number of monthly fees due in the period, from enrollment up to today"""
+    today = date.today()
+    first = (year, month or 1)
+    last = min((year, month or 12), (today.year, today.month))
+    if enrollment_date:
+        first = max(first, (enrollment_date.year, enrollment_date.month))
+    if first > last:
+        return 0
+    return (last[0] - first[0]) * 12 + last[1] - first[1] + 1
+
+
+def attendance_report(year, month=None):
+    """Attendance rate of active athletes with belt and payment status"""
+    session_dates = [day for (day,) in db.session.query(TrainingSession.date).filter(
+        TrainingSession.date >= date(year, month or 1, 1),
+        TrainingSession.date < (date(year, month + 1, 1) if month and month < 12 else date(year + 1, 1, 1))
+    ).order_by(TrainingSession.date)]
+
+    checkins = db.session.query(
+        MonthlyAttendance.athlete_id,
+        func.sum(MonthlyAttendance.checkins).label('checkins')
+    ).filter(MonthlyAttendance.year == year)
+    paid = db.session.query(
+        Payment.athlete_id,
+        func.count(func.distinct(Payment.month)).label('months')
+    ).filter(Payment.year == year)
+    if month:
+        checkins = checkins.filter(MonthlyAttendance.month == month)
+        paid = paid.filter(Payment.month == month)
+    checkins = checkins.group_by(MonthlyAttendance.athlete_id).subquery()
+    paid = paid.group_by(Payment.athlete_id).subquery()
+
+    rows = db.session.query(
+        Athlete.id,
+        Athlete.first_name,
+        Athlete.last_name,
+        Athlete.belt_color,
+        Athlete.enrollment_date,
+        func.coalesce(checkins.c.checkins, 0),
+        func.coalesce(paid.c.months, 0)
+    ).outerjoin(
+        checkins, checkins.c.athlete_id == Athlete.id
+    ).outerjoin(
+        paid, paid.c.athlete_id == Athlete.id
+    ).filter(Athlete.active == True).order_by(Athlete.last_name, Athlete.first_name).all()  # noqa: E712
+
+    athletes = []
+    belts = {belt: {'athletes': 0, 'checkins': 0, 'sessions': 0} for belt in BELT_COLORS}
+    for athlete_id, first_name, last_name, belt_color, enrollment_date, attended, paid_months in rows:
+        # Only the sessions held since the athlete enrolled
+        sessions = len(session_dates)
+        if enrollment_date:
+            sessions -= bisect_left(session_dates, enrollment_date)
+        months_due = _months_due(year, month, enrollment_date)
+
+        athletes.append({
+            'id': athlete_id,
+            'name': f"{first_name} {last_name}",
+            'belt': belt_color,
+            'checkins': int(attended),
+            'sessions': sessions,
+            'rate': round(min(attended / sessions, 1), 3) if sessions else 0,
+            'paid_months': paid_months,
+            'months_due': months_due,
+            'paid_up': paid_months >= months_due,
+        })
+        belt = belts.setdefault(belt_color, {'athletes': 0, 'checkins': 0, 'sessions': 0})
+        belt['athletes'] += 1
+        belt['checkins'] += int(attended)
+        belt['sessions'] += sessions
+
+    for belt in belts.values():
+        belt['rate'] = round(min(belt['checkins'] / belt['sessions'], 1), 3) if belt['sessions'] else 0
+
+    return {
+        'year': year,
+        'month': month,
+        'sessions': len(session_dates),
+        'athletes': athletes,
+        'belts': belts,
+    }
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""Genera gli estratti conto di tutti gli atleti attivi.
+
+Uso: python generate_statements.py ANNO [MESE] [--format pdf|html] [--workers N]
+
+Solo gli estratti i cui pagamenti sono cambiati vengono rigenerati; gli
+altri sono già nella cache in data/documents.
+"""
+import argparse
+
+from app import app
+import receipts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera gli estratti conto degli atleti attivi")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int, nargs="?", choices=range(1, 13), metavar="MESE")
+    parser.add_argument("--format", default="pdf", choices=sorted(receipts.RENDERERS))
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    with app.app_context():
+        rendered, cached = receipts.render_all_statements(args.year, args.month, args.format, args.workers)
+
+    print(f"Estratti conto generati: {rendered} nuovi, {cached} già aggiornati")
@@ -0,0 +1,351 @@
+"""Live dashboard updates.
+
+Every commit that touches Payment, Exam or Athlete is reduced to a small
+delta and appended as one JSON line to a shared event log. Each gunicorn
+worker runs a single thread that tails the log and fans new events out to
+its open SSE streams, so a change is computed once no matter how many
+dashboards are connected.
+
+Event format (one per commit):
+
+    {"payments": [{"year": 2025, "month": 3, "amount_cents": 3000}],
+     "exams": [{"year": 2025, "month": 3, "count": 1}],
+     "belts": {"Bianca": -1, "Gialla": 1}}
+
+Event ids are "<generation>-<offset>": the generation is the creation time
+(ms) stored in the first line of the log file, the offset the end of the
+event's line. When the log grows past MAX_LOG_SIZE it is rotated to
+events.log.1, so a reconnecting client can still catch up from the previous
+file. If its Last-Event-ID is older than that, it gets a "resync" event and
+should re-fetch /api/monthly-data and /api/belt-distribution.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Athlete, Payment, Exam
+
+EVENT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'events.log')
+EVENT_LOCK = EVENT_LOG + '.lock'
+MAX_LOG_SIZE = 1024 * 1024  # Rotate the log once it grows past 1 MB
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 15
+# Open streams per worker: each one holds a gunicorn thread (see --threads)
+MAX_STREAMS = int(os.environ.get('LIVE_MAX_STREAMS', 4))
+
+logger = logging.getLogger(__name__)
+
+# Delta collection
+
+def _old_value(obj, attr):
+    """Value of an attribute before the pending flush"""
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attr)
+
+
+def _collect(session, flush_context):
+    """Accumulate the deltas of a flush in the session until commit"""
+    payments = session.info.setdefault('live_payments', Counter())
+    exams = session.info.setdefault('live_exams', Counter())
+    belts = session.info.setdefault('live_belts', Counter())
+
+    for obj in session.new:
+        if isinstance(obj, Payment):
+            payments[(obj.year, obj.month)] += obj.amount_cents
+        elif isinstance(obj, Exam):
+            exams[(obj.exam_date.year, obj.exam_date.month)] += 1
+        elif isinstance(obj, Athlete) and obj.active:
+            belts[obj.belt_color] += 1
+
+    for obj in session.dirty:
+        if not session.is_modified(obj, include_collections=False):
+            continue
+        if isinstance(obj, Payment):
+            payments[(_old_value(obj, 'year'), _old_value(obj, 'month'))] -= _old_value(obj, 'amount_cents')
+            payments[(obj.year, obj.month)] += obj.amount_cents
+        elif isinstance(obj, Exam):
+            old_date = _old_value(obj, 'exam_date')
+            exams[(old_date.year, old_date.month)] -= 1
+            exams[(obj.exam_date.year, obj.exam_date.month)] += 1
+        elif isinstance(obj, Athlete):
+            if _old_value(obj, 'active'):
+                belts[_old_value(obj, 'belt_color')] -= 1
+            if obj.active:
+                belts[obj.belt_color] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Payment):
+            payments[(obj.year, obj.month)] -= obj.amount_cents
+        elif isinstance(obj, Exam):
+            exams[(obj.exam_date.year, obj.exam_date.month)] -= 1
+        elif isinstance(obj, Athlete) and obj.active:
+            belts[obj.belt_color] -= 1
+
+
+def _discard(session):
+    for key in ('live_payments', 'live_exams', 'live_belts'):
+        session.info.pop(key, None)
+
+
+def _publish_committed(session):
+    payments = session.info.get('live_payments', {})
+    exams = session.info.get('live_exams', {})
+    belts = session.info.get('live_belts', {})
+    _discard(session)
+
+    delta = {
+        'payments': [{'year': year, 'month': month, 'amount_cents': cents}
+                     for (year, month), cents in payments.items() if cents],
+        'exams': [{'year': year, 'month': month, 'count': count}
+                  for (year, month), count in exams.items() if count],
+        'belts': {belt: count for belt, count in belts.items() if count},
+    }
+    if not any(delta.values()):
+        return
+    try:
+        publish(delta)
+    except Exception:
+        # Best effort: the rows are already committed, never fail the write
+        logger.exception("Pubblicazione evento live fallita")
+
+
+event.listen(Session, 'after_flush', _collect)
+event.listen(Session, 'after_commit', _publish_committed)
+event.listen(Session, 'after_soft_rollback', lambda session, previous_transaction: _discard(session))
+
+# Cross-worker event log
+
+@contextmanager
+def _log_lock(operation=fcntl.LOCK_EX):
+    """Lock out rotation (shared) or other writers too (exclusive)"""
+    os.makedirs(os.path.dirname(EVENT_LOG), exist_ok=True)
+    with open(EVENT_LOCK, 'ab') as lock:
+        fcntl.flock(lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _new_log():
+    """Write an empty log file with a fresh generation, returning its path"""
+    tmp_path = f"{EVENT_LOG}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps({'generation': time.time_ns() // 1_000_000}).encode('utf-8') + b'\n')
+    return tmp_path
+
+
+def _ensure_log():
+    """Create the log on first use, or replace one without a valid header.
+
+    Returns its generation. Called with the exclusive lock held.
+    """
+    try:
+        with open(EVENT_LOG, 'rb') as f:
+            generation, _ = _read_header(f)
+    except FileNotFoundError:
+        generation = None
+    if generation is None:
+        new_log = _new_log()
+        with open(new_log, 'rb') as f:
+            generation, _ = _read_header(f)
+        os.replace(new_log, EVENT_LOG)
+    return generation
+
+
+def publish(delta):
+    """Append an event to the shared log, visible to every worker"""
+    line = (json.dumps(delta, separators=(',', ':')) + '\n').encode('utf-8')
+    with _log_lock():
+        _ensure_log()
+        if os.path.getsize(EVENT_LOG) > MAX_LOG_SIZE:
+            new_log = _new_log()
+            os.replace(EVENT_LOG, EVENT_LOG + '.1')
+            os.replace(new_log, EVENT_LOG)
+        with open(EVENT_LOG, 'ab') as f:
+            f.write(line)
+
+
+def _read_header(f):
+    """Generation and header size of an open log file"""
+    header = f.readline()
+    try:
+        generation = json.loads(header)['generation']
+    except (ValueError, KeyError, TypeError):
+        return None, len(header)
+    if not isinstance(generation, int) or isinstance(generation, bool):
+        return None, len(header)
+    return generation, len(header)
+
+
+def parse_event_id(event_id):
+    """(generation, offset) tuple of an event id, or None if malformed"""
+    try:
+        generation, offset = (int(part) for part in str(event_id).split('-'))
+    except ValueError:
+        return None
+    return generation, offset
+
+
+def current_event_id():
+    """Id of the last complete event in the log"""
+    with _log_lock():
+        generation = _ensure_log()
+        with open(EVENT_LOG, 'rb') as f:
+            offset = f.read().rfind(b'\n') + 1
+    return f"{generation}-{offset}"
+
+
+def read_events(last_event_id):
+    """Complete events written after an event id, as (id, json) pairs.
+
+    Returns None when the id is no longer in the current or previous log.
+    """
+    position = parse_event_id(last_event_id)
+    if position is None:
+        return None
+    generation, offset = position
+
+    with _log_lock(fcntl.LOCK_SH):
+        return _read_events(generation, offset)
+
+
+def _read_events(generation, offset):
+    events = []
+    found = False
+    for path in (EVENT_LOG + '.1', EVENT_LOG):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue  # Not rotated yet
+        with f:
+            file_generation, header_size = _read_header(f)
+            if not found:
+                if file_generation != generation:
+                    continue
+                found = True
+                if offset < header_size:
+                    return None
+                f.seek(offset - 1)
+                if f.read(1) != b'\n':
+                    return None  # Not the end of an event line
+            else:
+                offset = header_size  # Continue at the start of the newer file
+
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Still being written
+                offset += len(line)
+                events.append((f"{file_generation}-{offset}", line.decode('utf-8').rstrip('\n')))
+    return events if found else None
+
+
+class Broker:
+    """Fans the shared event log out to the SSE streams of this worker.
+
+    Subscribers receive (event_id, json) pairs; json is None for a resync.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self):
+        """Register a stream, or return None if this worker is at MAX_STREAMS"""
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            if len(self._subscribers) >= MAX_STREAMS:
+                return None
+            self._subscribers.add(subscriber)
+            # Started lazily so it lives in the worker, not in the pre-fork master
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._tail, daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _send(self, subscribers, event_id, data):
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_id, data))
+            except queue.Full:
+                # Slow client: drop its backlog and let it re-fetch everything
+                while not subscriber.empty():
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                subscriber.put_nowait((event_id, None))
+
+    def _tail(self):
+        last_event_id = current_event_id()
+        while True:
+            time.sleep(POLL_INTERVAL)
+            events = read_events(last_event_id)
+            with self._lock:
+                subscribers = list(self._subscribers)
+
+            if events is None:
+                # Rotated twice since the last poll: tell the clients to resync
+                last_event_id = current_event_id()
+                self._send(subscribers, last_event_id, None)
+                continue
+
+            for event_id, data in events:
+                self._send(subscribers, event_id, data)
+                last_event_id = event_id
+
+
+broker = Broker()
+
+
+def _message(event_id, data):
+    if data is None:
+        return f"id: {event_id}\nevent: resync\ndata: {{}}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+
+def stream(subscriber, last_event_id=None):
+    """Generator of SSE messages, replaying what a reconnecting client missed.
+
+    The caller subscribes and must unsubscribe when the response is closed.
+    """
+    yield "retry: 3000\n\n"
+    last_sent = (0, 0)
+    if last_event_id:
+        events = read_events(last_event_id)
+        if events is None:
+            events = [(current_event_id(), None)]
+        elif not events:
+            last_sent = parse_event_id(last_event_id)
+        for event_id, data in events:
+            last_sent = parse_event_id(event_id)
+            yield _message(event_id, data)
+
+    while True:
+        try:
+            event_id, data = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            yield ": heartbeat\n\n"
+            continue
+        position = parse_event_id(event_id)
+        if data is not None and position <= last_sent:
+            continue  # Already replayed
+        last_sent = position
+        yield _message(event_id, data)
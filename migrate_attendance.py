@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""Migrazione: aggiunge il PIN presenze agli atleti.
+
+Le tabelle training_session, attendance e monthly_attendance vengono create
+da db.create_all() all'avvio; qui serve solo la nuova colonna athlete.checkin_pin.
+
+Lo script è idempotente.
+"""
+from sqlalchemy import inspect, text
+
+from app import app, db
+
+with app.app_context():
+    inspector = inspect(db.engine)
+    existing = {column["name"] for column in inspector.get_columns("athlete")}
+
+    if "checkin_pin" in existing:
+        print("athlete.checkin_pin: già presente")
+    else:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE athlete ADD COLUMN checkin_pin VARCHAR(6)"))
+            conn.execute(text(
+                "CREATE UNIQUE INDEX ix_athlete_checkin_pin ON athlete (checkin_pin)"
+            ))
+        print("athlete.checkin_pin aggiunta")
+
+print("Migrazione presenze completata")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Migrazione: converte gli importi Float in centesimi interi.
+
+payment.amount -> payment.amount_cents
+exam.fee -> exam.fee_cents
+athlete.monthly_fee -> athlete.monthly_fee_cents
+
+Lo script è idempotente: le tabelle già migrate vengono saltate.
+"""
+from sqlalchemy import inspect, text
+
+from app import app, db
+
+columns_to_migrate = [
+    ("payment", "amount", "amount_cents"),
+    ("exam", "fee", "fee_cents"),
+    ("athlete", "monthly_fee", "monthly_fee_cents"),
+]
+
+with app.app_context():
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table, old_column, new_column in columns_to_migrate:
+            existing = {column["name"] for column in inspector.get_columns(table)}
+
+            if old_column not in existing:
+                print(f"{table}.{old_column}: già migrata")
+                continue
+
+            if new_column not in existing:
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN {new_column} INTEGER NOT NULL DEFAULT 0"
+                ))
+
+            conn.execute(text(
+                f"UPDATE {table} SET {new_column} = "
+                f"CAST(ROUND(COALESCE({old_column}, 0) * 100) AS INTEGER)"
+            ))
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {old_column}"))
+            print(f"{table}.{old_column} -> {table}.{new_column}")
+
+print("Importi convertiti in centesimi")
@@ -1,4 +1,5 @@
 from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
@@ -24,6 +25,20 @@ BELT_COLORS = [
     "Nera 5° Dan"
 ]
 
+CENT = Decimal("0.01")
+
+
+def to_cents(value):
+    """Converte un importo in euro (stringa, int, float o Decimal) in centesimi interi"""
+    amount = Decimal(str(value).strip().replace(",", "."))
+    return int(amount.quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def from_cents(cents):
+    """Converte centesimi interi in un Decimal esatto in euro"""
+    return (Decimal(int(cents or 0)) / 100).quantize(CENT)
+
+
 class Athlete(db.Model):
     """Model for karate athletes"""
     id = db.Column(db.Integer, primary_key=True)
@@ -35,9 +50,10 @@ class Athlete(db.Model):
     email = db.Column(db.String(120))
     belt_color = db.Column(db.String(20), nullable=False, default="Bianca")
     enrollment_date = db.Column(db.Date, default=datetime.now().date)
-    monthly_fee = db.Column(db.Float, default=0)  # Quota mensile in euro
+    monthly_fee_cents = db.Column(db.Integer, nullable=False, default=0)  # Quota mensile in centesimi
     notes = db.Column(db.Text)
     active = db.Column(db.Boolean, default=True)
+    checkin_pin = db.Column(db.String(6), unique=True)  # Codice numerico per la registrazione presenze
     
     # Relationships
     payments = db.relationship('Payment', backref='athlete', lazy=True, cascade="all, delete-orphan")
@@ -49,19 +65,35 @@ class Athlete(db.Model):
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
+    
+    @property
+    def monthly_fee(self):
+        return from_cents(self.monthly_fee_cents)
+    
+    @monthly_fee.setter
+    def monthly_fee(self, value):
+        self.monthly_fee_cents = to_cents(value)
 
 
 class Payment(db.Model):
     """Model for monthly payments"""
     id = db.Column(db.Integer, primary_key=True)
     athlete_id = db.Column(db.Integer, db.ForeignKey('athlete.id'), nullable=False)
-    amount = db.Column(db.Float, nullable=False)
+    amount_cents = db.Column(db.Integer, nullable=False)  # Importo in centesimi
     payment_date = db.Column(db.Date, nullable=False, default=datetime.now().date)
     month = db.Column(db.Integer, nullable=False)  # 1-12 for Jan-Dec
     year = db.Column(db.Integer, nullable=False)
     payment_method = db.Column(db.String(20), default="Cash")  # Cash, Bank Transfer, etc.
     notes = db.Column(db.Text)
     
+    @property
+    def amount(self):
+        return from_cents(self.amount_cents)
+    
+    @amount.setter
+    def amount(self, value):
+        self.amount_cents = to_cents(value)
+    
     def __repr__(self):
         return f"<Payment {self.id} - {self.amount}€ - {self.month}/{self.year}>"
 
@@ -74,14 +106,52 @@ class Exam(db.Model):
     previous_belt = db.Column(db.String(20), nullable=False)
     new_belt = db.Column(db.String(20), nullable=False)
     result = db.Column(db.String(20), default="Passed")  # Passed, Failed, Pending
-    fee = db.Column(db.Float, nullable=False, default=0.0)
+    fee_cents = db.Column(db.Integer, nullable=False, default=0)  # Tassa d'esame in centesimi
     paid = db.Column(db.Boolean, default=False)
     notes = db.Column(db.Text)
     
+    @property
+    def fee(self):
+        return from_cents(self.fee_cents)
+    
+    @fee.setter
+    def fee(self, value):
+        self.fee_cents = to_cents(value)
+    
     def __repr__(self):
         return f"<Exam {self.id} - {self.previous_belt} to {self.new_belt}>"
 
 
+class TrainingSession(db.Model):
+    """Model for held training sessions, filled in by the first check-in of each slot"""
+    date = db.Column(db.Date, primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, default=0)  # Inizio della sessione in minuti dalla mezzanotte
+    
+    def __repr__(self):
+        return f"<TrainingSession {self.date} {self.slot // 60:02d}:{self.slot % 60:02d}>"
+
+
+class Attendance(db.Model):
+    """Model for training check-ins, one row per athlete per session slot"""
+    date = db.Column(db.Date, primary_key=True)
+    athlete_id = db.Column(db.Integer, db.ForeignKey('athlete.id'), primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, default=0)  # Inizio della sessione in minuti dalla mezzanotte
+    
+    def __repr__(self):
+        return f"<Attendance {self.athlete_id} - {self.date} {self.slot // 60:02d}:{self.slot % 60:02d}>"
+
+
+class MonthlyAttendance(db.Model):
+    """Precomputed per-month check-in counters, kept in sync with Attendance"""
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)  # 1-12 for Jan-Dec
+    athlete_id = db.Column(db.Integer, db.ForeignKey('athlete.id'), primary_key=True)
+    checkins = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<MonthlyAttendance {self.athlete_id} - {self.month}/{self.year}: {self.checkins}>"
+
+
 class User(UserMixin, db.Model):
     """Model for user authentication"""
     id = db.Column(db.Integer, primary_key=True)
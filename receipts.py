@@ -0,0 +1,282 @@
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from jinja2 import Environment
+
+from app import db
+from models import Athlete, Payment, from_cents
+
+# Bump when the layout changes so cached documents are regenerated
+DOCUMENT_VERSION = 1
+
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'documents')
+
+MONTH_NAMES = [
+    "Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+    "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"
+]
+
+CLUB_NAME = "Karate Manager"
+
+COLUMNS = ["Data", "Mensilità", "Metodo", "Importo"]
+
+HTML_TEMPLATE = Environment(autoescape=True).from_string("""<!DOCTYPE html>
+<html lang="it">
+<head>
+<meta charset="utf-8">
+<title>{{ doc.title }}</title>
+<style>
+body { font-family: Helvetica, Arial, sans-serif; margin: 2em; }
+table { border-collapse: collapse; width: 100%; }
+th, td { border-bottom: 1px solid #ccc; padding: 4px 8px; text-align: left; }
+td.amount, th.amount { text-align: right; }
+</style>
+</head>
+<body>
+<h1>{{ doc.club }}</h1>
+<h2>{{ doc.title }}</h2>
+<dl>
+{% for label, value in doc.header %}<dt>{{ label }}</dt><dd>{{ value }}</dd>
+{% endfor %}</dl>
+<table>
+<thead><tr>{% for column in doc.columns %}<th{% if loop.last %} class="amount"{% endif %}>{{ column }}</th>{% endfor %}</tr></thead>
+<tbody>
+{% for row in doc.rows %}<tr>{% for cell in row %}<td{% if loop.last %} class="amount"{% endif %}>{{ cell }}</td>{% endfor %}</tr>
+{% endfor %}</tbody>
+<tfoot><tr><th colspan="{{ doc.columns|length - 1 }}">Totale</th><th class="amount">{{ doc.total }}</th></tr></tfoot>
+</table>
+</body>
+</html>
+""")
+
+
+def format_euro(cents):
+    """Format integer cents as an Italian euro amount"""
+    return f"€ {from_cents(cents):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def _payment_row(payment_date, month, year, amount_cents, payment_method):
+    return [
+        payment_date.strftime('%d/%m/%Y'),
+        f"{MONTH_NAMES[month - 1]} {year}",
+        payment_method or "",
+        format_euro(amount_cents),
+    ]
+
+
+def _period_label(year, month=None):
+    return f"{MONTH_NAMES[month - 1]} {year}" if month else str(year)
+
+
+def receipt_document(payment):
+    """Build the plain data of a payment receipt"""
+    athlete = payment.athlete
+    return {
+        'kind': 'receipt',
+        'key': f"receipt-{payment.id}",
+        'club': CLUB_NAME,
+        'title': f"Ricevuta di pagamento n. {payment.id}",
+        'header': [
+            ("Atleta", athlete.full_name),
+            ("Data pagamento", payment.payment_date.strftime('%d/%m/%Y')),
+        ],
+        'columns': COLUMNS,
+        'rows': [_payment_row(payment.payment_date, payment.month, payment.year,
+                              payment.amount_cents, payment.payment_method)],
+        'total': format_euro(payment.amount_cents),
+    }
+
+
+def _statement_query(year, month=None):
+    query = db.session.query(
+        Payment.athlete_id,
+        Payment.payment_date,
+        Payment.month,
+        Payment.year,
+        Payment.amount_cents,
+        Payment.payment_method
+    ).filter(Payment.year == year)
+    if month:
+        query = query.filter(Payment.month == month)
+    return query.order_by(Payment.month, Payment.payment_date, Payment.id)
+
+
+def _statement_document(athlete_id, full_name, rows, year, month=None):
+    period = _period_label(year, month)
+    return {
+        'kind': 'statement',
+        'key': f"statement-{athlete_id}-{year}-{month or 0}",
+        'club': CLUB_NAME,
+        'title': f"Estratto conto {period}",
+        'header': [
+            ("Atleta", full_name),
+            ("Periodo", period),
+        ],
+        'columns': COLUMNS,
+        'rows': [_payment_row(*row) for row in rows],
+        'total': format_euro(sum(row[3] for row in rows)),
+    }
+
+
+def statement_document(athlete, year, month=None):
+    """Build the plain data of an athlete's monthly or yearly statement"""
+    rows = _statement_query(year, month).filter(Payment.athlete_id == athlete.id).all()
+    return _statement_document(athlete.id, athlete.full_name, [row[1:] for row in rows], year, month)
+
+
+def active_statement_documents(year, month=None):
+    """Build the statements of every active athlete with two queries"""
+    athletes = db.session.query(
+        Athlete.id, Athlete.first_name, Athlete.last_name
+    ).filter_by(active=True).order_by(Athlete.last_name, Athlete.first_name).all()
+
+    rows_by_athlete = {athlete_id: [] for athlete_id, _, _ in athletes}
+    for row in _statement_query(year, month).filter(Payment.athlete_id.in_(rows_by_athlete)):
+        rows_by_athlete[row[0]].append(row[1:])
+
+    return [
+        _statement_document(athlete_id, f"{first_name} {last_name}",
+                            rows_by_athlete[athlete_id], year, month)
+        for athlete_id, first_name, last_name in athletes
+    ]
+
+
+def render_html(doc):
+    """Render a document as a standalone HTML page"""
+    return HTML_TEMPLATE.render(doc=doc).encode('utf-8')
+
+
+def _pdf_text(value):
+    text = str(value).encode('cp1252', errors='replace')
+    return text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def render_pdf(doc):
+    """Render a document as a minimal A4 PDF using only the standard Helvetica font"""
+    width, height, margin, leading = 595, 842, 50, 16
+    column_x = [margin, margin + 100, margin + 240, margin + 400]
+
+    # Each line is a list of (x, font, size, text) fragments
+    lines = [
+        [(margin, 'F2', 16, doc['club'])],
+        [(margin, 'F2', 13, doc['title'])],
+        [],
+    ]
+    lines += [[(margin, 'F2', 10, f"{label}:"), (margin + 100, 'F1', 10, value)] for label, value in doc['header']]
+    lines.append([])
+    lines.append([(x, 'F2', 10, column) for x, column in zip(column_x, doc['columns'])])
+    lines += [[(x, 'F1', 10, cell) for x, cell in zip(column_x, row)] for row in doc['rows']]
+    lines.append([])
+    lines.append([(column_x[0], 'F2', 11, "Totale"), (column_x[-1], 'F2', 11, doc['total'])])
+
+    per_page = (height - 2 * margin) // leading
+    pages = [lines[i:i + per_page] for i in range(0, len(lines), per_page)] or [[]]
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, filled in once the page object ids are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for page in pages:
+        stream = [b"BT"]
+        y = height - margin
+        for line in page:
+            for x, font, size, text in line:
+                stream.append(b"/%s %d Tf 1 0 0 1 %d %d Tm (%s) Tj" % (font.encode(), size, x, y, _pdf_text(text)))
+            y -= leading
+        stream.append(b"ET")
+        content = b"\n".join(stream)
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>"
+            % (width, height, len(objects))
+        )
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(output)
+
+
+RENDERERS = {
+    'html': render_html,
+    'pdf': render_pdf,
+}
+
+
+def cache_path(doc, fmt):
+    """Path of the cached rendering, keyed by a hash of the document content"""
+    payload = json.dumps([DOCUMENT_VERSION, fmt, doc], sort_keys=True, default=str)
+    digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_FOLDER, f"{doc['key']}-{digest}.{fmt}")
+
+
+def _remove_stale(doc, fmt, path):
+    """Delete the older renderings of the same document"""
+    prefix = os.path.join(CACHE_FOLDER, f"{doc['key']}-")
+    for old_path in glob.glob(f"{glob.escape(prefix)}*.{fmt}"):
+        digest = old_path[len(prefix):-len(fmt) - 1]
+        if old_path != path and re.fullmatch(r'[0-9a-f]{16}', digest):
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass  # Already removed by another worker
+
+
+def render_cached(doc, fmt='pdf'):
+    """Render a document, reusing the on-disk copy when its content has not changed"""
+    path = cache_path(doc, fmt)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    data = RENDERERS[fmt](doc)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    _remove_stale(doc, fmt, path)
+    return path
+
+
+def stale_statements(year, month=None, fmt='pdf'):
+    """Statements of active athletes, split into (stale, cached) lists"""
+    stale, cached = [], []
+    for doc in active_statement_documents(year, month):
+        (cached if os.path.exists(cache_path(doc, fmt)) else stale).append(doc)
+    return stale, cached
+
+
+def render_all_statements(year, month=None, fmt='pdf', workers=None):
+    """Render the statements of every active athlete in a process pool.
+
+    Returns a (rendered, cached) tuple: only statements whose payment rows
+    changed since the last run are sent to the pool. Meant for the
+    generate_statements.py script, not for request handlers.
+    """
+    stale, cached = stale_statements(year, month, fmt)
+
+    if stale:
+        # forkserver: never fork a process that may hold other threads' locks
+        context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            list(executor.map(render_cached, stale, [fmt] * len(stale)))
+
+    return len(stale), len(cached)
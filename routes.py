@@ -1,6 +1,7 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify
+from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, abort, Response
 from datetime import datetime
 import calendar
+from collections import namedtuple
 from sqlalchemy import extract, func
 import json
 from flask_wtf import FlaskForm
@@ -9,7 +10,13 @@ from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Le
 from flask_login import login_user, logout_user, login_required, current_user
 
 from app import app, db
-from models import Athlete, Payment, Exam, BELT_COLORS, User
+from models import Athlete, Payment, Exam, BELT_COLORS, User, Attendance, MonthlyAttendance, to_cents, from_cents
+import receipts
+import live
+import attendance
+
+# Same fields as the labeled rows of the payment methods query
+PaymentMethodTotal = namedtuple('PaymentMethodTotal', ['payment_method', 'total'])
 
 # Add 'now' variable to all templates
 @app.context_processor
@@ -51,12 +58,14 @@ def index():
     monthly_payments = Payment.query.filter(
         Payment.month == current_month,
         Payment.year == current_year
-    ).with_entities(func.sum(Payment.amount)).scalar() or 0
+    ).with_entities(func.sum(Payment.amount_cents)).scalar()
+    monthly_payments = from_cents(monthly_payments)
     
     # Get yearly payments total
     yearly_payments = Payment.query.filter(
         Payment.year == current_year
-    ).with_entities(func.sum(Payment.amount)).scalar() or 0
+    ).with_entities(func.sum(Payment.amount_cents)).scalar()
+    yearly_payments = from_cents(yearly_payments)
     
     # Get belt distribution
     belt_counts = db.session.query(
@@ -69,14 +78,14 @@ def index():
     
     # Get monthly payments by month
     monthly_payment_data = db.session.query(
-        Payment.month, func.sum(Payment.amount)
+        Payment.month, func.sum(Payment.amount_cents)
     ).filter(
         Payment.year == current_year
     ).group_by(Payment.month).all()
     
     monthly_data = [0] * 12
-    for month, amount in monthly_payment_data:
-        monthly_data[month-1] = float(amount)
+    for month, cents in monthly_payment_data:
+        monthly_data[month-1] = float(from_cents(cents))
     
     return render_template(
         'index.html', 
@@ -88,6 +97,15 @@ def index():
     )
 
 # Athletes Routes
+def _checkin_pin(value):
+    """Validate the optional attendance PIN of an athlete"""
+    pin = (value or '').strip()
+    if not pin:
+        return None
+    if not pin.isdigit() or not 4 <= len(pin) <= 6:
+        raise ValueError('Il PIN presenze deve contenere da 4 a 6 cifre.')
+    return pin
+
 @app.route('/athletes')
 @login_required
 def athletes_list():
@@ -104,7 +122,8 @@ def add_athlete():
             birth_date = datetime.strptime(request.form['birth_date'], '%Y-%m-%d').date()
             enrollment_date = datetime.strptime(request.form['enrollment_date'], '%Y-%m-%d').date() if request.form['enrollment_date'] else datetime.now().date()
             
-            monthly_fee = max(5.0, float(request.form['monthly_fee']) if request.form['monthly_fee'] else 5.0)
+            monthly_fee_cents = max(500, to_cents(request.form['monthly_fee']) if request.form['monthly_fee'] else 500)
+            checkin_pin = _checkin_pin(request.form.get('checkin_pin'))
             
             athlete = Athlete(
                 first_name=request.form['first_name'],
@@ -115,7 +134,8 @@ def add_athlete():
                 email=request.form['email'],
                 belt_color=request.form['belt_color'],
                 enrollment_date=enrollment_date,
-                monthly_fee=monthly_fee,
+                monthly_fee_cents=monthly_fee_cents,
+                checkin_pin=checkin_pin,
                 notes=request.form['notes'],
                 active=('active' in request.form)
             )
@@ -155,7 +175,9 @@ def edit_athlete(athlete_id):
             athlete.email = request.form['email']
             athlete.belt_color = request.form['belt_color']
             athlete.enrollment_date = datetime.strptime(request.form['enrollment_date'], '%Y-%m-%d').date()
-            athlete.monthly_fee = max(5.0, float(request.form['monthly_fee']) if request.form['monthly_fee'] else 5.0)
+            athlete.monthly_fee_cents = max(500, to_cents(request.form['monthly_fee']) if request.form['monthly_fee'] else 500)
+            if 'checkin_pin' in request.form:
+                athlete.checkin_pin = _checkin_pin(request.form['checkin_pin'])
             athlete.notes = request.form['notes']
             athlete.active = ('active' in request.form)
             
@@ -174,6 +196,9 @@ def delete_athlete(athlete_id):
     athlete = Athlete.query.get_or_404(athlete_id)
     
     try:
+        # Bulk delete the check-ins instead of loading them through a relationship
+        Attendance.query.filter_by(athlete_id=athlete.id).delete()
+        MonthlyAttendance.query.filter_by(athlete_id=athlete.id).delete()
         db.session.delete(athlete)
         db.session.commit()
         flash('Atleta eliminato con successo!', 'success')
@@ -202,10 +227,10 @@ def payments_list():
     if athlete_id:
         query = query.filter(Payment.athlete_id == athlete_id)
     
-    payments = query.order_by(Payment.payment_date.desc()).all()
+    # Get total (computed by the database on the filtered rows)
+    total = from_cents(query.with_entities(func.sum(Payment.amount_cents)).scalar())
     
-    # Get total
-    total = sum(payment.amount for payment in payments)
+    payments = query.order_by(Payment.payment_date.desc()).all()
     
     # Get all athletes for filter dropdown
     athletes = Athlete.query.order_by(Athlete.last_name).all()
@@ -236,13 +261,13 @@ def add_payment(athlete_id):
     
     try:
         payment_date = datetime.strptime(request.form['payment_date'], '%Y-%m-%d').date()
-        amount = float(request.form['amount'])
+        amount_cents = to_cents(request.form['amount'])
         month = int(request.form['month'])
         year = int(request.form['year'])
         
         payment = Payment(
             athlete_id=athlete.id,
-            amount=amount,
+            amount_cents=amount_cents,
             payment_date=payment_date,
             month=month,
             year=year,
@@ -275,6 +300,50 @@ def delete_payment(payment_id):
     
     return redirect(url_for('athlete_detail', athlete_id=athlete_id))
 
+# Receipt and statement Routes
+def _send_document(doc, download_name):
+    """Send a cached HTML or PDF rendering of a receipt/statement"""
+    fmt = request.args.get('format', default='pdf')
+    if fmt not in receipts.RENDERERS:
+        abort(400)
+    
+    path = receipts.render_cached(doc, fmt)
+    return send_file(path, download_name=f"{download_name}.{fmt}", as_attachment=(fmt == 'pdf'))
+
+@app.route('/payments/<int:payment_id>/receipt')
+@login_required
+def payment_receipt(payment_id):
+    """Payment receipt as PDF or HTML"""
+    payment = Payment.query.get_or_404(payment_id)
+    return _send_document(receipts.receipt_document(payment), f"ricevuta-{payment.id}")
+
+@app.route('/athletes/<int:athlete_id>/statement')
+@login_required
+def athlete_statement(athlete_id):
+    """Monthly or yearly statement of an athlete as PDF or HTML"""
+    athlete = Athlete.query.get_or_404(athlete_id)
+    year = request.args.get('year', default=datetime.now().year, type=int)
+    month = request.args.get('month', default=None, type=int)
+    if month is not None and not 1 <= month <= 12:
+        abort(400)
+    
+    doc = receipts.statement_document(athlete, year, month)
+    period = f"{year}-{month:02d}" if month else str(year)
+    return _send_document(doc, f"estratto-{athlete.last_name}-{period}")
+
+@app.route('/api/statements/status')
+@login_required
+def statements_status():
+    """Count the statements of active athletes that need to be regenerated"""
+    year = request.args.get('year', default=datetime.now().year, type=int)
+    month = request.args.get('month', default=None, type=int)
+    fmt = request.args.get('format', default='pdf')
+    if fmt not in receipts.RENDERERS or (month is not None and not 1 <= month <= 12):
+        abort(400)
+    
+    stale, cached = receipts.stale_statements(year, month, fmt)
+    return jsonify({'stale': len(stale), 'cached': len(cached)})
+
 # Exam Routes
 @app.route('/athletes/<int:athlete_id>/exams/add', methods=['POST'])
 def add_exam(athlete_id):
@@ -283,7 +352,7 @@ def add_exam(athlete_id):
     
     try:
         exam_date = datetime.strptime(request.form['exam_date'], '%Y-%m-%d').date()
-        fee = float(request.form['fee'])
+        fee_cents = to_cents(request.form['fee'])
         
         exam = Exam(
             athlete_id=athlete.id,
@@ -291,7 +360,7 @@ def add_exam(athlete_id):
             previous_belt=athlete.belt_color,
             new_belt=request.form['new_belt'],
             result=request.form['result'],
-            fee=fee,
+            fee_cents=fee_cents,
             paid=('paid' in request.form),
             notes=request.form['notes']
         )
@@ -325,6 +394,53 @@ def delete_exam(exam_id):
     
     return redirect(url_for('athlete_detail', athlete_id=athlete_id))
 
+# Attendance Routes
+@app.route('/api/attendance/checkin', methods=['POST'])
+@login_required
+def attendance_checkin():
+    """Register a training check-in by athlete PIN or id"""
+    data = request.get_json(silent=True) if request.is_json else request.form
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Richiesta non valida'}), 400
+    pin = str(data.get('pin') or '').strip()
+    athlete_id = str(data.get('athlete_id') or '').strip()
+    
+    query = Athlete.query.with_entities(Athlete.id, Athlete.first_name, Athlete.last_name, Athlete.belt_color)
+    if pin:
+        if not (pin.isdecimal() and pin.isascii() and len(pin) <= 6):
+            return jsonify({'error': 'PIN non valido'}), 400
+        athlete = query.filter_by(checkin_pin=pin, active=True).first()
+    elif athlete_id:
+        # Athlete ids are 32-bit integers: reject anything the database can't compare
+        if not (athlete_id.isdecimal() and athlete_id.isascii() and 0 < int(athlete_id) < 2 ** 31):
+            return jsonify({'error': 'Atleta non valido'}), 400
+        athlete = query.filter_by(id=int(athlete_id), active=True).first()
+    else:
+        return jsonify({'error': 'PIN o atleta mancante'}), 400
+    
+    if athlete is None:
+        return jsonify({'error': 'Atleta non trovato'}), 404
+    
+    if not attendance.checkin_buffer.add(app, athlete.id):
+        return jsonify({'error': 'Troppe presenze in attesa di scrittura, riprova'}), 503
+    
+    return jsonify({
+        'id': athlete.id,
+        'name': f"{athlete.first_name} {athlete.last_name}",
+        'belt': athlete.belt_color
+    })
+
+@app.route('/api/attendance-report')
+@login_required
+def get_attendance_report():
+    """Get attendance report data"""
+    year = request.args.get('year', default=datetime.now().year, type=int)
+    month = request.args.get('month', default=None, type=int)
+    if month is not None and not 1 <= month <= 12:
+        abort(400)
+    
+    return jsonify(attendance.attendance_report(year, month))
+
 # Reports Route
 @app.route('/reports')
 def reports():
@@ -335,7 +451,7 @@ def reports():
     # Monthly payment totals for the year
     monthly_totals = db.session.query(
         Payment.month,
-        func.sum(Payment.amount).label('total')
+        func.sum(Payment.amount_cents).label('total')
     ).filter(
         Payment.year == year
     ).group_by(Payment.month).all()
@@ -343,7 +459,7 @@ def reports():
     # Create a list with all months (even those with 0)
     monthly_data = [0] * 12
     for month, total in monthly_totals:
-        monthly_data[month-1] = float(total)
+        monthly_data[month-1] = float(from_cents(total))
     
     # Belt distribution
     belt_distribution = db.session.query(
@@ -358,13 +474,19 @@ def reports():
     # Payment methods distribution
     payment_methods = db.session.query(
         Payment.payment_method,
-        func.sum(Payment.amount).label('total')
+        func.sum(Payment.amount_cents).label('total')
     ).filter(
         Payment.year == year
     ).group_by(Payment.payment_method).all()
+    payment_methods = [
+        PaymentMethodTotal(row.payment_method, float(from_cents(row.total)))
+        for row in payment_methods
+    ]
     
     # Total income for year
-    yearly_total = sum(monthly_data)
+    yearly_total = from_cents(Payment.query.filter(
+        Payment.year == year
+    ).with_entities(func.sum(Payment.amount_cents)).scalar())
     
     # Years for dropdown
     current_year = datetime.now().year
@@ -401,7 +523,7 @@ def get_monthly_data():
     
     monthly_totals = db.session.query(
         Payment.month,
-        func.sum(Payment.amount).label('total')
+        func.sum(Payment.amount_cents).label('total')
     ).filter(
         Payment.year == year
     ).group_by(Payment.month).all()
@@ -409,7 +531,7 @@ def get_monthly_data():
     # Create a list with all months (even those with 0)
     monthly_data = [0] * 12
     for month, total in monthly_totals:
-        monthly_data[month-1] = float(total)
+        monthly_data[month-1] = float(from_cents(total))
     
     return jsonify(monthly_data)
 
@@ -427,6 +549,23 @@ def get_belt_distribution():
     
     return jsonify(belt_data)
 
+@app.route('/api/stream')
+@login_required
+def dashboard_stream():
+    """Server-sent events with payment, exam and belt deltas for the dashboard"""
+    subscriber = live.broker.subscribe()
+    if subscriber is None:
+        # Too many open streams on this worker: the client falls back to polling
+        return jsonify({'error': 'Troppe connessioni live aperte'}), 503
+    
+    response = Response(
+        live.stream(subscriber, request.headers.get('Last-Event-ID')),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(lambda: live.broker.unsubscribe(subscriber))
+    return response
+
 
 # Forms per autenticazione
 class LoginForm(FlaskForm):
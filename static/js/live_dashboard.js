@@ -0,0 +1,98 @@
+/*
+ * Aggiornamenti live dei grafici della dashboard via server-sent events.
+ *
+ * Uso nel template, dopo aver creato i grafici Chart.js:
+ *
+ *   <script src="{{ url_for('static', filename='js/live_dashboard.js') }}"></script>
+ *   <script>
+ *     LiveDashboard.connect({monthlyChart: monthlyChart, beltChart: beltChart, year: {{ now.year }}});
+ *   </script>
+ *
+ * monthlyChart: 12 valori in euro (Gennaio-Dicembre) nel primo dataset.
+ * beltChart: le cinture come labels e il numero di atleti nel primo dataset.
+ *
+ * Se /api/stream non è disponibile (browser senza EventSource o server al
+ * limite di connessioni live, risposta 503) si torna al polling delle API.
+ */
+var LiveDashboard = (function () {
+    'use strict';
+
+    var POLL_INTERVAL = 60000;
+
+    function refresh(options) {
+        fetch('/api/monthly-data?year=' + options.year)
+            .then(function (response) { return response.json(); })
+            .then(function (monthlyData) {
+                options.monthlyChart.data.datasets[0].data = monthlyData;
+                options.monthlyChart.update();
+            });
+
+        fetch('/api/belt-distribution')
+            .then(function (response) { return response.json(); })
+            .then(function (beltData) {
+                var chart = options.beltChart;
+                chart.data.datasets[0].data = chart.data.labels.map(function (belt) {
+                    return beltData[belt] || 0;
+                });
+                chart.update();
+            });
+    }
+
+    function applyDelta(options, delta) {
+        var monthly = options.monthlyChart.data.datasets[0].data;
+        (delta.payments || []).forEach(function (payment) {
+            if (payment.year === options.year) {
+                // Work in cents to avoid float drift on repeated updates
+                var cents = Math.round(monthly[payment.month - 1] * 100) + payment.amount_cents;
+                monthly[payment.month - 1] = cents / 100;
+            }
+        });
+
+        var belts = options.beltChart.data;
+        Object.keys(delta.belts || {}).forEach(function (belt) {
+            var index = belts.labels.indexOf(belt);
+            if (index !== -1) {
+                belts.datasets[0].data[index] += delta.belts[belt];
+            }
+        });
+
+        options.monthlyChart.update();
+        options.beltChart.update();
+    }
+
+    function poll(options) {
+        setInterval(function () { refresh(options); }, POLL_INTERVAL);
+    }
+
+    function connect(options) {
+        if (!window.EventSource) {
+            poll(options);
+            return;
+        }
+
+        var source = new EventSource('/api/stream');
+        var opened = false;
+
+        source.addEventListener('open', function () {
+            // Catch up with changes made between page load and the first connection
+            if (!opened) {
+                opened = true;
+                refresh(options);
+            }
+        });
+        source.addEventListener('message', function (event) {
+            applyDelta(options, JSON.parse(event.data));
+        });
+        source.addEventListener('resync', function () {
+            refresh(options);
+        });
+        source.addEventListener('error', function () {
+            // The browser retries on its own unless the server refused the stream
+            if (source.readyState === EventSource.CLOSED) {
+                poll(options);
+            }
+        });
+    }
+
+    return {connect: connect};
+})();